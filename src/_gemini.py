@@ -0,0 +1,141 @@
+"""
+Shared Google Gemini client setup for the generation and evaluation scripts.
+"""
+
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import random
+import sys
+import time
+from typing import Dict, List, Optional
+
+try:
+    import google.generativeai as genai
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    print("[ERROR] The 'google-generativeai' package is not installed or not in the current Python environment.")
+    print("Please install it by running: pip install google-generativeai")
+    sys.exit(1)
+
+try:
+    # The newer google-genai SDK is only needed for batch jobs
+    from google import genai as genai_sdk
+except ImportError:
+    genai_sdk = None
+
+BATCH_AVAILABLE = genai_sdk is not None
+BATCH_POLL_INTERVAL = 30  # seconds
+_BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+
+# Transient errors (429 / 503) that are worth retrying after a backoff
+RETRYABLE_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable)
+
+_MODEL_CACHE: Dict[str, genai.GenerativeModel] = {}
+
+
+def _get_model(model_name: str) -> genai.GenerativeModel:
+    """Returns a GenerativeModel for the given name, constructing it only once."""
+    model = _MODEL_CACHE.get(model_name)
+    if model is None:
+        model = genai.GenerativeModel(model_name)
+        _MODEL_CACHE[model_name] = model
+    return model
+
+
+def use_context_cache(model_name: str, static_prefix: str, ttl_minutes: int) -> Optional[str]:
+    """Stores static_prefix in Gemini's context cache and registers a model bound to it.
+
+    Returns the model name to use with _get_model() from then on, or None if the
+    cache could not be created (e.g. the prefix is below the model's minimum
+    cacheable size), in which case callers should keep sending full prompts.
+    """
+    try:
+        cached_content = genai.caching.CachedContent.create(
+            model=model_name,
+            contents=[static_prefix],
+            ttl=datetime.timedelta(minutes=ttl_minutes),
+        )
+    except Exception as e:
+        print(f"[WARNING] Could not create a Gemini context cache, sending full prompts instead: {e}")
+        return None
+
+    # The prefix digest keeps response-cache keys distinct per template
+    digest = hashlib.blake2b(static_prefix.encode(), digest_size=8).hexdigest()
+    cached_model_name = f"{model_name}@context-{digest}"
+    _MODEL_CACHE[cached_model_name] = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+    print(f"[INFO] Using Gemini context cache {cached_content.name} for the static prompt prefix")
+    return cached_model_name
+
+
+class RateLimiter:
+    """Async context manager that spaces request starts evenly to stay under a per-minute quota."""
+
+    def __init__(self, requests_per_minute: int):
+        self._interval = 60.0 / requests_per_minute
+        self._next_slot = 0.0
+
+    async def __aenter__(self):
+        # Claim a slot before awaiting, so concurrent tasks queue up in order
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+_RATE_LIMITER: Optional[RateLimiter] = None
+
+
+def set_rate_limit(requests_per_minute: int) -> None:
+    """Shares one limiter across all API calls in the process; 0 disables limiting."""
+    global _RATE_LIMITER
+    _RATE_LIMITER = RateLimiter(requests_per_minute) if requests_per_minute > 0 else None
+
+
+def rate_limited():
+    """Returns the shared rate limiter, or a no-op context when limiting is disabled."""
+    return _RATE_LIMITER if _RATE_LIMITER is not None else contextlib.nullcontext()
+
+
+def backoff_delay(attempt: int) -> float:
+    """Exponential backoff with jitter for the given zero-based attempt, capped at a minute."""
+    return min(60, 2 ** attempt + random.random())
+
+
+async def generate_batch(api_key: str, model_name: str, prompts: List[str]) -> List[Optional[str]]:
+    """Runs prompts as one Gemini batch job and returns the response texts in prompt order.
+
+    Requests that failed inside the job come back as None.
+    """
+    client = genai_sdk.Client(api_key=api_key)
+    async with rate_limited():
+        job = await client.aio.batches.create(
+            model=model_name,
+            src=[{"contents": [{"role": "user", "parts": [{"text": prompt}]}]} for prompt in prompts],
+        )
+    while job.state.name not in _BATCH_DONE_STATES:
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        job = await client.aio.batches.get(name=job.name)
+
+    if job.state.name not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+        print(f"[ERROR] Batch job {job.name} finished in state {job.state.name}: {job.error}")
+        return [None] * len(prompts)
+
+    inlined = job.dest.inlined_responses if job.dest else None
+    texts = [
+        item.response.text if item.response is not None and item.error is None else None
+        for item in inlined or []
+    ]
+    return texts + [None] * (len(prompts) - len(texts))
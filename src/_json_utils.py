@@ -0,0 +1,130 @@
+"""
+Shared JSON helpers: pulling payloads out of LLM responses and fast
+(de)serialization via orjson, falling back to the stdlib json module.
+"""
+
+import json
+import os
+import re
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Matches JSON wrapped in markdown ```json ... ```
+_JSON_BLOCK_RE = re.compile(r"```json\n(.*?)\n```", re.DOTALL)
+
+
+def extract_json_from_response(response_text: str, expected_type: Optional[type] = None) -> Optional[str]:
+    """Extracts a JSON string from a response, handling markdown and other text.
+
+    Outside a ```json block, balanced {...} or [...] spans are tried in order and
+    the first one that parses (to expected_type, when given) is returned, so a
+    bracketed aside such as "[1]" does not shadow the payload. If none qualifies,
+    the first balanced span is returned and the caller reports the parse error.
+    """
+    if not response_text:
+        return None
+
+    match = _JSON_BLOCK_RE.search(response_text)
+    if match:
+        return match.group(1).strip()
+
+    first_span = None
+    pos = 0
+    while True:
+        span_start, span_end = _balanced_span(response_text, pos)
+        if span_start == -1:
+            return first_span
+        span = response_text[span_start:span_end].strip()
+        if first_span is None:
+            first_span = span
+        try:
+            parsed = loads(span)
+        except ValueError:  # json.JSONDecodeError and orjson's are both ValueErrors
+            pass
+        else:
+            if expected_type is None or isinstance(parsed, expected_type):
+                return span
+        # Resume after the rejected span: a fragment of a broken payload is not the payload
+        pos = span_end
+
+
+def _balanced_span(text: str, pos: int):
+    """Returns (start, end) of the first balanced {...} or [...] span at or after pos, skipping brackets inside strings."""
+    depth = 0
+    start = -1
+    in_string = False
+    escape = False
+    for i in range(pos, len(text)):
+        char = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char in '{[':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif start == -1:
+            continue
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                return start, i + 1
+        elif char == '"':
+            in_string = True
+
+    return -1, -1
+
+
+def loads(data) -> Any:
+    """Parses a JSON str or bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps_pretty(obj: Any) -> str:
+    """Serializes obj as 2-space indented JSON, using orjson when it is installed."""
+    if orjson is not None:
+        # OPT_NON_STR_KEYS matches json.dumps, which stringifies int/None keys
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, indent=2)
+
+
+def _json_default(obj: Any) -> Any:
+    """Converts numpy arrays and scalars for the stdlib json fallback."""
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Writes data to path via a temporary file and os.replace, so a crash never leaves a partial file."""
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json_atomic(path: str, obj: Any) -> None:
+    """Atomically writes obj to path as 2-space indented JSON in a single write.
+
+    numpy arrays and scalars in obj are written as JSON arrays and numbers.
+    """
+    if orjson is not None:
+        data = orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        data = json.dumps(obj, indent=2, default=_json_default).encode()
+    write_atomic(path, data)
@@ -0,0 +1,45 @@
+"""
+On-disk cache of LLM responses keyed by model and prompt.
+
+The cache is disabled until open_cache() is called, so get() and put() are
+safe to call unconditionally from the API helpers.
+"""
+
+import hashlib
+import os
+import sqlite3
+from typing import Optional
+
+CACHE_DIR_NAME = '.llm_cache'
+
+_conn: Optional[sqlite3.Connection] = None
+
+
+def open_cache(base_dir: str) -> None:
+    """Opens (creating if needed) the response cache under base_dir."""
+    global _conn
+    cache_dir = os.path.join(base_dir, CACHE_DIR_NAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    _conn = sqlite3.connect(os.path.join(cache_dir, 'responses.sqlite3'))
+    _conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL)")
+    _conn.commit()
+
+
+def _key(model: str, prompt: str) -> str:
+    return hashlib.blake2b(f"{model}\x00{prompt}".encode()).hexdigest()
+
+
+def get(model: str, prompt: str) -> Optional[str]:
+    """Returns the cached response for (model, prompt), or None on a miss."""
+    if _conn is None:
+        return None
+    row = _conn.execute("SELECT response FROM responses WHERE key = ?", (_key(model, prompt),)).fetchone()
+    return row[0] if row else None
+
+
+def put(model: str, prompt: str, response: str) -> None:
+    """Stores a response for (model, prompt)."""
+    if _conn is None:
+        return
+    _conn.execute("INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)", (_key(model, prompt), response))
+    _conn.commit()
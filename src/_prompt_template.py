@@ -0,0 +1,56 @@
+"""
+Pre-parsed prompt templates, split once into literal and placeholder segments.
+"""
+
+import re
+from typing import Optional, Tuple
+
+# Only bare identifiers count as placeholders, so the JSON examples in the
+# prompt files can keep their literal braces.
+_PLACEHOLDER_RE = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+Segments = Tuple[Tuple[str, Optional[str]], ...]
+
+
+def compile_template(template: str) -> Segments:
+    """Splits a template into (literal_text, placeholder_name) pairs."""
+    segments = []
+    pos = 0
+    for match in _PLACEHOLDER_RE.finditer(template):
+        segments.append((template[pos:match.start()], match.group(1)))
+        pos = match.end()
+    segments.append((template[pos:], None))
+    return tuple(segments)
+
+
+def _render(segments: Segments, **kwargs: str) -> str:
+    """Fills the placeholders of a compiled template in a single join.
+
+    Placeholders without a matching keyword are left untouched.
+    """
+    parts = []
+    for literal, name in segments:
+        parts.append(literal)
+        if name is not None:
+            parts.append(kwargs[name] if name in kwargs else f"{{{name}}}")
+    return "".join(parts)
+
+
+def split_for_context_cache(segments: Segments) -> Tuple[str, Segments]:
+    """Splits a template into a static prefix and the segments of the per-request payload.
+
+    Placeholders in the prefix become references to tagged sections of the
+    payload, so the prefix is byte-identical across requests and can be cached
+    server-side.
+    """
+    prefix_parts = []
+    payload_parts = ["---"]
+    seen = set()
+    for literal, name in segments:
+        prefix_parts.append(literal)
+        if name is not None:
+            prefix_parts.append(f"<{name}> (provided after the --- separator)")
+            if name not in seen:
+                seen.add(name)
+                payload_parts.append(f"<{name}>\n{{{name}}}\n</{name}>")
+    return "".join(prefix_parts), compile_template("\n".join(payload_parts))
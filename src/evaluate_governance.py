@@ -10,22 +10,22 @@ import random
 from typing import List, Dict, Any, Optional
 import openai
 import sys
-import queue
-import threading
-import re
+import asyncio
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timezone
 
-try:
-    import google.generativeai as genai
-except ImportError:
-    print("[ERROR] The 'google-generativeai' package is not installed or not in the current Python environment.")
-    print("Please install it by running: pip install google-generativeai")
-    sys.exit(1)
+import numpy as np
 
+import _llm_cache
+from _gemini import genai, _get_model, RETRYABLE_ERRORS, backoff_delay, rate_limited, set_rate_limit, generate_batch, use_context_cache, BATCH_AVAILABLE
+from _json_utils import extract_json_from_response, loads, dumps_pretty, write_json_atomic
+from _prompt_template import Segments, compile_template, split_for_context_cache, _render
+
+DETECTION_METRICS = ("detection_rate", "false_positive_rate", "risk_coverage_rate")
+INTELLIGENCE_METRICS = ("causal_chain_clarity_score", "predictive_alerting_score", "proactive_intervention_rate")
+SCORE_METRICS = ("governance_maturity_score",) + DETECTION_METRICS + INTELLIGENCE_METRICS
+VIOLATION_FIELDS = ("violations_detected", "violations_missed", "false_positives")
 
-# Global lock for thread-safe operations
-file_lock = threading.Lock()
 
 def load_prompt_template(prompt_file: str) -> Optional[str]:
     """Load a prompt template from a file."""
@@ -37,63 +37,37 @@ def load_prompt_template(prompt_file: str) -> Optional[str]:
         return None
 
 
-def extract_json_from_response(response_text: str) -> Optional[str]:
-    """Extracts a JSON string from a response, handling markdown and other text."""
-    if not response_text:
-        return None
-
-    # Regex to find JSON wrapped in markdown ```json ... ```
-    match = re.search(r"```json\n(.*?)\n```", response_text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
-
-    # Fallback: find the first '{' or '[' and the last '}' or ']'
-    start_bracket = -1
-    end_bracket = -1
-
-    first_curly = response_text.find('{')
-    first_square = response_text.find('[')
-
-    if first_curly == -1:
-        start_bracket = first_square
-    elif first_square == -1:
-        start_bracket = first_curly
-    else:
-        start_bracket = min(first_curly, first_square)
-
-    if start_bracket == -1:
-        return None
-
-    last_curly = response_text.rfind('}')
-    last_square = response_text.rfind(']')
-    end_bracket = max(last_curly, last_square)
-
-    if end_bracket == -1 or end_bracket < start_bracket:
-        return None
-
-    return response_text[start_bracket:end_bracket + 1].strip()
-
-
-def process_run_directory(run_dir, prompt_template, api_key, model):
+def build_evaluation_prompt(run_dir: str, prompt_segments: Segments) -> Optional[str]:
+    """Renders the evaluation prompt for a run directory, or returns None if its data is unusable."""
     scenario_path = os.path.join(run_dir, 'scenario.json')
     governance_path = os.path.join(run_dir, 'governance.json')
 
     try:
         with open(scenario_path, 'r') as f:
             scenario_str = f.read()
-        with open(governance_path, 'r') as f:
-            all_logs = json.load(f)
+        with open(governance_path, 'rb') as f:
+            all_logs = loads(f.read())
 
         # Separate logs by framework for cleaner injection into the prompt
-        mi9_logs = [log for log in all_logs if log.get('type') == 'MI9_GOVERNANCE']
-        otel_logs = [log for log in all_logs if log.get('type') == 'OPENTELEMETRY']
-        langsmith_logs = [log for log in all_logs if log.get('type') == 'LANGSMITH']
+        mi9_logs, otel_logs, langsmith_logs = [], [], []
+        buckets = {
+            'MI9_GOVERNANCE': mi9_logs,
+            'OPENTELEMETRY': otel_logs,
+            'LANGSMITH': langsmith_logs,
+            # Older governance logs in data/ were generated with this label
+            'LANGCHAIN': langsmith_logs,
+        }
+        for log in all_logs:
+            bucket = buckets.get(log.get('type'))
+            if bucket is not None:
+                bucket.append(log)
 
-        prompt = prompt_template.format(
+        return _render(
+            prompt_segments,
             scenario_json=scenario_str,
-            mi9_logs_json=json.dumps(mi9_logs, indent=2),
-            opentelemetry_logs_json=json.dumps(otel_logs, indent=2),
-            langsmith_logs_json=json.dumps(langsmith_logs, indent=2)
+            mi9_logs_json=dumps_pretty(mi9_logs),
+            opentelemetry_logs_json=dumps_pretty(otel_logs),
+            langsmith_logs_json=dumps_pretty(langsmith_logs)
         )
 
     except FileNotFoundError as e:
@@ -103,138 +77,265 @@ def process_run_directory(run_dir, prompt_template, api_key, model):
         print(f"[ERROR] Skipping directory {run_dir}: Invalid JSON in data files.")
         return None
 
-    # Call the Gemini API
+
+def _full_model_name(model: str) -> str:
+    return model if model.startswith("models/") else f"models/{model}"
+
+
+async def process_run_directory(run_dir, prompt_segments, model):
+    # Read and render in a worker thread so disk I/O overlaps other in-flight API calls
+    prompt = await asyncio.to_thread(build_evaluation_prompt, run_dir, prompt_segments)
+    if prompt is None:
+        return None
+
+    model_name = _full_model_name(model)
+    cached_response = _llm_cache.get(model_name, prompt)
+    if cached_response is not None:
+        print(f"[INFO] Using cached evaluation response for {run_dir}")
+        return parse_evaluation(run_dir, cached_response)
+
+    # Call the Gemini API, backing off on rate limits and temporary outages
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            model = _get_model(model_name)
+
+            request_options = {"timeout": 120}  # 120 seconds
+            async with rate_limited():
+                response = await model.generate_content_async(
+                    prompt,
+                    request_options=request_options
+                )
+            response_text = response.text
+        except RETRYABLE_ERRORS as e:
+            if attempt + 1 == max_retries:
+                print(f"[ERROR] Transient Gemini API error in {run_dir} persisted after {max_retries} attempts: {e}")
+                return None
+            delay = backoff_delay(attempt)
+            print(f"[WARNING] Transient Gemini API error in {run_dir} ({e}). Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+            continue
+        except Exception as e:
+            print(f"[ERROR] An error occurred with the Gemini API in {run_dir}: {e}")
+            return None
+
+        evaluation = parse_evaluation(run_dir, response_text)
+        if evaluation is not None:
+            # Only responses that parsed are cached, so a bad one is retried on the next run
+            _llm_cache.put(model_name, prompt, response_text)
+        return evaluation
+
+
+def parse_evaluation(run_dir: str, response_text: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Extracts and parses the evaluation JSON from a model response, or returns None if it is unusable."""
+    extracted_json = extract_json_from_response(response_text, expected_type=dict)
+    if not extracted_json:
+        return None
+
     try:
-        genai.configure(api_key=api_key)
-        model_name = model if model.startswith("models/") else f"models/{model}"
-        model = genai.GenerativeModel(model_name)
-        
-        request_options = {"timeout": 120}  # 120 seconds
-        response = model.generate_content(
-            prompt,
-            request_options=request_options
-        )
-        return extract_json_from_response(response.text)
-    except Exception as e:
-        print(f"[ERROR] An error occurred with the Gemini API in {run_dir}: {e}")
+        evaluation = loads(extracted_json)
+    except json.JSONDecodeError as e:
+        print(f"[ERROR] Failed to parse evaluation JSON for {run_dir}: {e}")
         return None
+    if not isinstance(evaluation, dict):
+        print(f"[ERROR] Evaluation for {run_dir} is a JSON {type(evaluation).__name__}, not an object")
+        return None
+    return evaluation
+
+
+def save_evaluation(run_dir: str, evaluation: Optional[Dict[str, Any]], results_list: list):
+    """Writes a parsed evaluation to evaluation.json and records it for aggregation."""
+    if evaluation is None:
+        print(f"[ERROR] Failed to evaluate for {run_dir}")
+        return
+
+    # Parsed once: the same object is written to disk and handed to the aggregation
+
+    # Save the individual evaluation file
+    output_path = os.path.join(run_dir, 'evaluation.json')
+    try:
+        write_json_atomic(output_path, evaluation)
+        print(f"[SUCCESS] Saved evaluation for {run_dir}")
+    except IOError as e:
+        print(f"[ERROR] Failed to save evaluation.json for {run_dir}: {e}")
+
+    # Every task runs on the same event loop, so the shared list needs no lock
+    results_list.append(evaluation)
 
 
-def worker(
-    task_queue: queue.Queue,
+async def evaluate_run_directory(
+    run_dir: str,
     results_list: list,
-    file_lock: threading.Lock,
-    api_key: str,
     model: str,
-    prompt_template: str
+    prompt_segments: Segments,
+    semaphore: asyncio.Semaphore
 ):
-    while True:
-        try:
-            run_dir = task_queue.get_nowait()
-        except queue.Empty:
-            break
-
+    """Evaluate a single run directory, respecting the semaphore."""
+    async with semaphore:
         print(f"Evaluating governance for: {run_dir}")
-        extracted_json = process_run_directory(run_dir, prompt_template, api_key, model)
-
-        if extracted_json:
-            # Save the individual evaluation file
-            output_path = os.path.join(run_dir, 'evaluation.json')
-            try:
-                with open(output_path, 'w') as f:
-                    # The extracted content might be a JSON string inside a markdown block
-                    # So we load and dump it to ensure it's clean JSON
-                    json_content = json.loads(extracted_json)
-                    json.dump(json_content, f, indent=2)
-                print(f"[SUCCESS] Saved evaluation for {run_dir}")
-            except (json.JSONDecodeError, IOError) as e:
-                print(f"[ERROR] Failed to save evaluation.json for {run_dir}: {e}")
-
-            with file_lock:
-                results_list.append(extracted_json)
-                # print(f"Successfully evaluated for {run_dir}")
+        evaluation = await process_run_directory(run_dir, prompt_segments, model)
+
+    save_evaluation(run_dir, evaluation, results_list)
+
+
+async def evaluate_batch(
+    run_dirs: List[str],
+    results_list: list,
+    model: str,
+    prompt_segments: Segments,
+    api_key: str
+):
+    """Evaluate a group of run directories through a single Gemini batch job."""
+    model_name = _full_model_name(model)
+    pending = []
+    prompts = await asyncio.gather(*[
+        asyncio.to_thread(build_evaluation_prompt, run_dir, prompt_segments)
+        for run_dir in run_dirs
+    ])
+    for run_dir, prompt in zip(run_dirs, prompts):
+        if prompt is None:
+            continue
+        cached_response = _llm_cache.get(model_name, prompt)
+        if cached_response is not None:
+            print(f"[INFO] Using cached evaluation response for {run_dir}")
+            save_evaluation(run_dir, parse_evaluation(run_dir, cached_response), results_list)
         else:
-            print(f"[ERROR] Failed to evaluate for {run_dir}")
-        
-        task_queue.task_done()
+            pending.append((run_dir, prompt))
+
+    if not pending:
+        return
+
+    print(f"Submitting batch job with {len(pending)} evaluations")
+    try:
+        responses = await generate_batch(api_key, model_name, [prompt for _, prompt in pending])
+    except Exception as e:
+        print(f"[ERROR] Gemini batch job failed: {e}")
+        responses = [None] * len(pending)
+
+    for (run_dir, prompt), response_text in zip(pending, responses):
+        evaluation = parse_evaluation(run_dir, response_text)
+        if evaluation is not None:
+            _llm_cache.put(model_name, prompt, response_text)
+        save_evaluation(run_dir, evaluation, results_list)
 
 
-def aggregate_and_save_summary(all_evaluations: List[str], output_dir: str):
-    if not all_evaluations:
+async def run_all(
+    run_dirs: List[str],
+    concurrency: int,
+    model: str,
+    prompt_segments: Segments,
+    batch_size: int = 0,
+    api_key: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """Evaluates all run directories concurrently and returns the parsed evaluations.
+
+    With a batch_size, full groups of runs go through Gemini batch jobs and
+    only the trailing remainder is sent as individual requests.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    results_list = []
+    batched = len(run_dirs) - len(run_dirs) % batch_size if batch_size > 0 else 0
+    # range() rejects a zero step, so the default batch_size of 0 must skip it entirely
+    batch_starts = range(0, batched, batch_size) if batch_size > 0 else ()
+    tasks = [
+        evaluate_batch(run_dirs[i:i + batch_size], results_list, model, prompt_segments, api_key)
+        for i in batch_starts
+    ]
+    tasks += [
+        evaluate_run_directory(run_dir, results_list, model, prompt_segments, semaphore)
+        for run_dir in run_dirs[batched:]
+    ]
+    await asyncio.gather(*tasks)
+    return results_list
+
+
+def _mean(values: np.ndarray) -> float:
+    """Mean of an array, or 0 when it is empty."""
+    return float(values.mean()) if values.size else 0
+
+
+def aggregate_and_save_summary(all_parsed_evals: List[Dict[str, Any]], output_dir: str):
+    if not all_parsed_evals:
         print("[WARNING] No evaluation results to aggregate.")
         return
 
-    all_parsed_evals = [json.loads(e) for e in all_evaluations if e]
     total_samples = len(all_parsed_evals)
 
-    # --- Aggregate Performance Comparison --- #
     frameworks = ["mi9_governance", "opentelemetry", "langsmith"]
-    perf_data = {}
-    for framework in frameworks:
-        rates, positives, risk_coverage_rates = [], [], []
-        detected_violations, missed_violations, false_positives = set(), set(), set()
-        clarity_scores, predictive_scores, maturity_scores, proactive_intervention_rates = [], [], [], []
+    # One preallocated array per (framework, metric); counts[framework] is the fill level
+    scores = {
+        framework: {metric: np.zeros(total_samples) for metric in SCORE_METRICS}
+        for framework in frameworks
+    }
+    counts = dict.fromkeys(frameworks, 0)
+    violations = {framework: {field: set() for field in VIOLATION_FIELDS} for framework in frameworks}
+
+    scenario_category_counts = defaultdict(int)
+    emergent_risk_counts = defaultdict(int)
+    scenario_keys_to_track = ["agent_type", "agent_architecture", "industry", "region", "attack_type", "safety_criticality"]
+    scenario_breakdown = {key: defaultdict(int) for key in scenario_keys_to_track}
+
+    # Single pass feeds both the performance comparison and the appendix statistics
+    for e in all_parsed_evals:
+        # --- Appendix Statistics --- #
+        details = e.get("scenario_details", {})
+        scenario_category_counts[details.get("scenario_category", "Unknown")] += 1
+        for risk in e.get("ground_truth", {}).get("emergent_risks_identified", []):
+            emergent_risk_counts[risk] += 1
+
+        for key in scenario_keys_to_track:
+            if key in details:
+                scenario_breakdown[key][details[key]] += 1
 
-        for e in all_parsed_evals:
-            comp = e.get("performance_comparison", {}).get(framework, {})
+        # --- Performance Comparison --- #
+        comparison = e.get("performance_comparison", {})
+        for framework in frameworks:
+            comp = comparison.get(framework, {})
             if not comp: continue
 
+            i = counts[framework]
+            counts[framework] += 1
+            framework_scores = scores[framework]
+
             # Aggregate new maturity score
-            maturity_scores.append(comp.get("governance_maturity_score", 0))
+            framework_scores["governance_maturity_score"][i] = comp.get("governance_maturity_score", 0)
 
             # Aggregate detection metrics
             metrics = comp.get("detection_metrics", {})
-            rates.append(metrics.get("detection_rate", 0))
-            positives.append(metrics.get("false_positive_rate", 0))
-            risk_coverage_rates.append(metrics.get("risk_coverage_rate", 0))
-            for v in metrics.get("violations_detected", []): detected_violations.add(v)
-            for v in metrics.get("violations_missed", []): missed_violations.add(v)
-            for v in metrics.get("false_positives", []): false_positives.add(v)
+            for metric in DETECTION_METRICS:
+                framework_scores[metric][i] = metrics.get(metric, 0)
+            for field, seen in violations[framework].items():
+                seen.update(metrics.get(field, []))
 
             # Aggregate actionable intelligence metrics
             intelligence = comp.get("actionable_intelligence", {})
-            clarity_scores.append(intelligence.get("causal_chain_clarity_score", 0))
-            predictive_scores.append(intelligence.get("predictive_alerting_score", 0))
-            proactive_intervention_rates.append(intelligence.get("proactive_intervention_rate", 0))
-        
-        if not rates: continue
+            for metric in INTELLIGENCE_METRICS:
+                framework_scores[metric][i] = intelligence.get(metric, 0)
+
+    perf_data = {}
+    for framework in frameworks:
+        n = counts[framework]
+        if not n: continue
 
+        avg = {metric: _mean(values[:n]) for metric, values in scores[framework].items()}
+        seen = violations[framework]
         perf_data[framework] = {
-            "governance_maturity_score_avg": sum(maturity_scores) / len(maturity_scores) if maturity_scores else 0,
+            "governance_maturity_score_avg": avg["governance_maturity_score"],
             "detection_metrics_avg": {
-                "detection_rate_avg": sum(rates) / len(rates),
-                "false_positive_rate_avg": sum(positives) / len(positives),
-                "risk_coverage_rate_avg": sum(risk_coverage_rates) / len(risk_coverage_rates) if risk_coverage_rates else 0,
-                "total_violations_detected": sorted(list(detected_violations)),
-                "total_violations_missed": sorted(list(missed_violations)),
-                "total_false_positives": sorted(list(false_positives))
+                **{f"{metric}_avg": avg[metric] for metric in DETECTION_METRICS},
+                "total_violations_detected": sorted(seen["violations_detected"]),
+                "total_violations_missed": sorted(seen["violations_missed"]),
+                "total_false_positives": sorted(seen["false_positives"])
             },
             "actionable_intelligence_avg": {
-                "causal_chain_clarity_score_avg": sum(clarity_scores) / len(clarity_scores) if clarity_scores else 0,
-                "predictive_alerting_score_avg": sum(predictive_scores) / len(predictive_scores) if predictive_scores else 0,
-                "proactive_intervention_rate_avg": sum(proactive_intervention_rates) / len(proactive_intervention_rates) if proactive_intervention_rates else 0
+                f"{metric}_avg": avg[metric] for metric in INTELLIGENCE_METRICS
             }
         }
 
-    # --- Aggregate Appendix Statistics --- #
-    scenario_category_counts = defaultdict(int)
-    emergent_risk_counts = defaultdict(int)
-    scenario_keys_to_track = ["agent_type", "agent_architecture", "industry", "region", "attack_type", "safety_criticality"]
-    scenario_breakdown = {key: defaultdict(int) for key in scenario_keys_to_track}
-
-    for e in all_parsed_evals:
-        details = e.get("scenario_details", {})
-        scenario_category_counts[details.get("scenario_category", "Unknown")] += 1
-        for risk in e.get("ground_truth", {}).get("emergent_risks_identified", []):
-            emergent_risk_counts[risk] += 1
-        
-        for key in scenario_keys_to_track:
-            if key in details:
-                scenario_breakdown[key][details[key]] += 1
-
+    report_generated_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
     summary = {
         "metadata": {
-            "report_generated_at": datetime.utcnow().isoformat(),
+            "report_generated_at": report_generated_at,
             "total_scenarios_evaluated": total_samples
         },
         "performance_summary": perf_data,
@@ -247,8 +348,7 @@ def aggregate_and_save_summary(all_evaluations: List[str], output_dir: str):
 
     output_path = os.path.join(output_dir, 'evaluation_summary.json')
     try:
-        with open(output_path, 'w') as f:
-            json.dump(summary, f, indent=2)
+        write_json_atomic(output_path, summary)
         print(f"[SUCCESS] Aggregated summary saved to {output_path}")
     except IOError as e:
         print(f"[ERROR] Could not write summary file to {output_path}: {e}")
@@ -261,43 +361,56 @@ def main():
 
     parser = argparse.ArgumentParser(description="Evaluate MI9 governance logs.")
     parser.add_argument("--input-dir", default=default_input_dir, help="Directory with run folders.")
-    parser.add_argument("--num-workers", type=int, default=4, help="Number of concurrent threads.")
+    parser.add_argument("--num-workers", type=int, default=4, help="Number of concurrent API requests.")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="Cap on Gemini requests per minute across all workers (0 = unlimited).")
     parser.add_argument("--model", default="gemini-1.5-flash-latest", help="Gemini model for evaluation.")
     parser.add_argument("--api-key", help="Google API key.")
     parser.add_argument("--evaluation-prompt", default=default_prompt_path, help="Path to the evaluation prompt.")
+    parser.add_argument("--no-cache", action='store_true', help="Bypass the on-disk LLM response cache.")
+    parser.add_argument("--context-cache-ttl", type=int, default=0, help="Cache the static prompt prefix with Gemini context caching for this many minutes (0 = disabled).")
+    parser.add_argument("--batch-size", type=int, default=0, help="Submit evaluations as Gemini batch jobs of this size (0 = individual requests; requires google-genai).")
     args = parser.parse_args()
 
     api_key = args.api_key or os.environ.get("GOOGLE_API_KEY")
     if not api_key:
         print("Error: GOOGLE_API_KEY not found.")
         sys.exit(1)
+    genai.configure(api_key=api_key)
+    set_rate_limit(args.requests_per_minute)
+
+    if args.batch_size > 0 and not BATCH_AVAILABLE:
+        print("Error: --batch-size requires the 'google-genai' package. Install it with: pip install google-genai")
+        sys.exit(1)
+    if args.batch_size > 0 and args.context_cache_ttl > 0:
+        print("Error: --batch-size and --context-cache-ttl cannot be combined.")
+        sys.exit(1)
 
     prompt_template = load_prompt_template(args.evaluation_prompt)
     if not prompt_template:
         sys.exit(1)
+    prompt_segments = compile_template(prompt_template)
 
     if not os.path.isdir(args.input_dir):
         print(f"Error: Input directory not found at {args.input_dir}")
         sys.exit(1)
 
-    task_queue = queue.Queue()
-    run_dirs = [os.path.join(args.input_dir, d) for d in os.listdir(args.input_dir) if os.path.isdir(os.path.join(args.input_dir, d))]
-    for run_dir in run_dirs:
-        task_queue.put(run_dir)
+    if not args.no_cache:
+        _llm_cache.open_cache(args.input_dir)
 
-    if task_queue.empty():
+    with os.scandir(args.input_dir) as entries:
+        run_dirs = [e.path for e in entries if not e.name.startswith('.') and e.is_dir(follow_symlinks=False)]
+    if not run_dirs:
         print("No run directories found to evaluate.")
         return
 
-    results_list = []
-    threads = []
-    for _ in range(args.num_workers):
-        thread = threading.Thread(target=worker, args=(task_queue, results_list, file_lock, api_key, args.model, prompt_template))
-        threads.append(thread)
-        thread.start()
-
-    for thread in threads:
-        thread.join()
+    model = args.model
+    if args.context_cache_ttl > 0:
+        static_prefix, payload_segments = split_for_context_cache(prompt_segments)
+        cached_model = use_context_cache(_full_model_name(model), static_prefix, args.context_cache_ttl)
+        if cached_model:
+            model, prompt_segments = cached_model, payload_segments
+
+    results_list = asyncio.run(run_all(run_dirs, args.num_workers, model, prompt_segments, args.batch_size, api_key))
 
     aggregate_and_save_summary(results_list, args.input_dir)
 
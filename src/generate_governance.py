@@ -3,14 +3,18 @@ import json
 import sys
 import asyncio
 import argparse
-import re
-from typing import Optional, Dict, List
+from typing import Any, Optional, Dict, List
+
+import _llm_cache
+from _gemini import genai, _get_model, RETRYABLE_ERRORS, backoff_delay, rate_limited, set_rate_limit, use_context_cache
+from _json_utils import extract_json_from_response, loads, dumps_pretty, write_json_atomic
+from _prompt_template import Segments, compile_template, split_for_context_cache, _render
 
 def load_json_file(file_path: str) -> Optional[Dict]:
     """Loads a JSON file from the specified path."""
     try:
-        with open(file_path, 'r') as f:
-            return json.load(f)
+        with open(file_path, 'rb') as f:
+            return loads(f.read())
     except (FileNotFoundError, json.JSONDecodeError) as e:
         print(f"[ERROR] Could not load or parse JSON from {file_path}: {e}")
         return None
@@ -24,90 +28,74 @@ def load_prompt_template(path: str) -> Optional[str]:
         print(f"[ERROR] Prompt file not found at: {path}")
         return None
 
-async def call_gemini_api(prompt: str, api_key: str, model: str) -> Optional[str]:
+async def call_gemini_api(prompt: str, model: str) -> Optional[str]:
     """Asynchronously call Google Gemini API."""
-    try:
-        import google.generativeai as genai
-    except ImportError:
-        print("[ERROR] The 'google-generativeai' package is not installed. Please run: pip install google-generativeai")
-        sys.exit(1)
+    model_instance = _get_model(model)
 
-    genai.configure(api_key=api_key)
-    model_instance = genai.GenerativeModel(model)
-    
     request_options = {"timeout": 180}  # 3 minutes
     generation_config = {
         "temperature": 0.7,
         "max_output_tokens": 8192
     }
 
-    response = await model_instance.generate_content_async(
-        prompt,
-        generation_config=generation_config,
-        request_options=request_options
-    )
+    async with rate_limited():
+        response = await model_instance.generate_content_async(
+            prompt,
+            generation_config=generation_config,
+            request_options=request_options
+        )
     return response.text
 
-def extract_json_from_response(response_text: str) -> Optional[str]:
-    """Extracts a JSON string from a response, handling markdown and other text."""
-    if not response_text:
-        return None
-
-    # Regex to find JSON wrapped in markdown ```json ... ```
-    match = re.search(r"```json\n(.*?)\n```", response_text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
-
-    # Fallback: find the first '{' or '[' and the last '}' or ']'
-    start_bracket = -1
-    end_bracket = -1
-
-    first_curly = response_text.find('{')
-    first_square = response_text.find('[')
-
-    if first_curly == -1:
-        start_bracket = first_square
-    elif first_square == -1:
-        start_bracket = first_curly
-    else:
-        start_bracket = min(first_curly, first_square)
-
-    if start_bracket == -1:
-        return None
-
-    last_curly = response_text.rfind('}')
-    last_square = response_text.rfind(']')
-    end_bracket = max(last_curly, last_square)
+async def generate_governance(scenario_data: Dict, model: str, prompt_segments: Segments, read_cache: bool = True) -> Optional[Any]:
+    """Asynchronously generates parsed governance logs based on a scenario, with retries.
 
-    if end_bracket == -1 or end_bracket < start_bracket:
-        return None
+    With read_cache=False a fresh response is always requested, and it replaces any cached one.
+    """
+    # The prompt does not change between attempts, so build it once
+    scenario_json_str = dumps_pretty(scenario_data)
+    prompt = _render(prompt_segments, scenario_json=scenario_json_str)
 
-    return response_text[start_bracket:end_bracket + 1].strip()
+    cached_response = _llm_cache.get(model, prompt) if read_cache else None
+    if cached_response is not None:
+        print(f"[INFO] Using cached governance log for scenario: {scenario_data.get('scenario_name', 'N/A')}")
+        return loads(extract_json_from_response(cached_response, expected_type=list))
 
-async def generate_governance(scenario_data: Dict, api_key: str, model: str, prompt_template: str) -> Optional[str]:
-    """Asynchronously generates a governance log JSON string based on a scenario, with retries."""
-    scenario_json_str = json.dumps(scenario_data, indent=2)
-    prompt = prompt_template.replace("{scenario_json}", scenario_json_str)
-    
     max_retries = 3
     for attempt in range(max_retries):
         print(f"Generating governance log for scenario: {scenario_data.get('scenario_name', 'N/A')} (Attempt {attempt + 1}/{max_retries})")
-        response_text = await call_gemini_api(prompt, api_key, model)
-        
+        # No sleep after the final attempt; the loop ends with the error below
+        is_last_attempt = attempt + 1 == max_retries
+        try:
+            response_text = await call_gemini_api(prompt, model)
+        except RETRYABLE_ERRORS as e:
+            if is_last_attempt:
+                print(f"[WARNING] Transient API error for scenario: {scenario_data.get('scenario_name', 'N/A')} ({e}).")
+                continue
+            delay = backoff_delay(attempt)
+            print(f"[WARNING] Transient API error for scenario: {scenario_data.get('scenario_name', 'N/A')} ({e}). Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+            continue
+        except Exception as e:
+            print(f"[ERROR] An error occurred with the Gemini API for scenario {scenario_data.get('scenario_name', 'N/A')}: {e}")
+            return None
+
         if not response_text:
-            print(f"[WARNING] API call failed for scenario: {scenario_data.get('scenario_name', 'N/A')}. Retrying...")
-            await asyncio.sleep(2) # Wait before retrying
+            print(f"[WARNING] API call failed for scenario: {scenario_data.get('scenario_name', 'N/A')}.{'' if is_last_attempt else ' Retrying...'}")
+            if not is_last_attempt:
+                await asyncio.sleep(backoff_delay(attempt)) # Wait before retrying
             continue
 
-        extracted_json = extract_json_from_response(response_text)
+        extracted_json = extract_json_from_response(response_text, expected_type=list)
         if not extracted_json:
-            print(f"[WARNING] Failed to extract JSON on attempt {attempt + 1}. Response: {response_text[:200]}... Retrying...")
-            await asyncio.sleep(2)
+            print(f"[WARNING] Failed to extract JSON on attempt {attempt + 1}. Response: {response_text[:200]}...{'' if is_last_attempt else ' Retrying...'}")
+            if not is_last_attempt:
+                await asyncio.sleep(backoff_delay(attempt))
             continue
 
         try:
-            json.loads(extracted_json)
-            return extracted_json # Success!
+            governance_logs = loads(extracted_json)
+            _llm_cache.put(model, prompt, response_text)
+            return governance_logs # Success!
         except (json.JSONDecodeError, TypeError):
             print(f"[ERROR] Failed to parse governance JSON from API response: {extracted_json}")
             return None
@@ -115,42 +103,38 @@ async def generate_governance(scenario_data: Dict, api_key: str, model: str, pro
     print(f"[ERROR] Failed to generate a valid governance log for scenario {scenario_data.get('scenario_name', 'N/A')} after {max_retries} attempts.")
     return None
 
-async def process_directory(data_dir: str, api_key: str, model: str, prompt_template: str, semaphore: asyncio.Semaphore, overwrite: bool):
+async def process_directory(data_dir: str, model: str, prompt_segments: Segments, semaphore: asyncio.Semaphore, overwrite: bool):
     """Process a single data directory to generate governance logs, respecting the semaphore."""
     async with semaphore:
-        try:
-            scenario_path = os.path.join(data_dir, 'scenario.json')
-            if not os.path.exists(scenario_path):
-                return
-
-            governance_path = os.path.join(data_dir, 'governance.json')
-            if os.path.exists(governance_path) and not overwrite:
-                print(f"[INFO] Skipping {os.path.basename(data_dir)} because 'governance.json' already exists. Use --overwrite to regenerate.")
-                return
-
-            print(f"--- Processing directory: {data_dir} ---")
-            scenario_data = load_json_file(scenario_path)
-            if not scenario_data:
-                print(f"[WARNING] Could not load scenario from {scenario_path}, skipping.")
-                return
-
-            governance_json_str = await generate_governance(scenario_data, api_key, model, prompt_template)
-
-            if governance_json_str:
-                with open(governance_path, 'w') as f:
-                    parsed_json = json.loads(governance_json_str)
-                    json.dump(parsed_json, f, indent=2)
-                print(f"Successfully generated and saved governance log to {governance_path}")
-            else:
-                print(f"[ERROR] Failed to generate governance log for {data_dir}, skipping.")
-        finally:
-            semaphore.release()
-
-async def run_all(subdirectories: List[str], concurrency: int, api_key: str, model: str, prompt_template: str, overwrite: bool):
+        scenario_path = os.path.join(data_dir, 'scenario.json')
+        if not os.path.exists(scenario_path):
+            return
+
+        governance_path = os.path.join(data_dir, 'governance.json')
+        if os.path.exists(governance_path) and not overwrite:
+            print(f"[INFO] Skipping {os.path.basename(data_dir)} because 'governance.json' already exists. Use --overwrite to regenerate.")
+            return
+
+        print(f"--- Processing directory: {data_dir} ---")
+        scenario_data = load_json_file(scenario_path)
+        if not scenario_data:
+            print(f"[WARNING] Could not load scenario from {scenario_path}, skipping.")
+            return
+
+        # --overwrite asks for new logs, so it must not replay a cached response
+        governance_logs = await generate_governance(scenario_data, model, prompt_segments, read_cache=not overwrite)
+
+        if governance_logs is not None:
+            write_json_atomic(governance_path, governance_logs)
+            print(f"Successfully generated and saved governance log to {governance_path}")
+        else:
+            print(f"[ERROR] Failed to generate governance log for {data_dir}, skipping.")
+
+async def run_all(subdirectories: List[str], concurrency: int, model: str, prompt_segments: Segments, overwrite: bool):
     """Sets up and runs the asyncio tasks for all subdirectories."""
     semaphore = asyncio.Semaphore(concurrency)
     tasks = [
-        process_directory(data_dir, api_key, model, prompt_template, semaphore, overwrite)
+        process_directory(data_dir, model, prompt_segments, semaphore, overwrite)
         for data_dir in subdirectories
     ]
     await asyncio.gather(*tasks)
@@ -167,27 +151,34 @@ def main():
     parser.add_argument("--api-key", help="Google API key (or set GOOGLE_API_KEY).")
     parser.add_argument("--governance-prompt", default=default_prompt_path, help="Path to the governance prompt file.")
     parser.add_argument("--concurrency", type=int, default=5, help="Number of parallel requests to make.")
-    parser.add_argument("--overwrite", action='store_true', help="Overwrite existing governance.json files.")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="Cap on Gemini requests per minute across all workers (0 = unlimited).")
+    parser.add_argument("--overwrite", action='store_true', help="Overwrite existing governance.json files with freshly generated logs (cached responses are not reused).")
+    parser.add_argument("--context-cache-ttl", type=int, default=0, help="Cache the static prompt prefix with Gemini context caching for this many minutes (0 = disabled).")
+    parser.add_argument("--no-cache", action='store_true', help="Bypass the on-disk LLM response cache.")
     args = parser.parse_args()
 
     api_key = args.api_key or os.environ.get("GOOGLE_API_KEY")
     if not api_key:
         print("[ERROR] Google API key must be provided via --api-key or GOOGLE_API_KEY env var.")
         sys.exit(1)
+    genai.configure(api_key=api_key)
+    set_rate_limit(args.requests_per_minute)
 
     prompt_template = load_prompt_template(args.governance_prompt)
     if not prompt_template:
         sys.exit(1)
+    prompt_segments = compile_template(prompt_template)
 
     if not os.path.isdir(args.base_dir):
         print(f"[ERROR] Base directory not found: {args.base_dir}")
         sys.exit(1)
 
-    all_subdirectories = [
-        os.path.join(args.base_dir, d)
-        for d in os.listdir(args.base_dir)
-        if os.path.isdir(os.path.join(args.base_dir, d))
-    ]
+    with os.scandir(args.base_dir) as entries:
+        all_subdirectories = [
+            e.path
+            for e in entries
+            if not e.name.startswith('.') and e.is_dir(follow_symlinks=False)
+        ]
 
     if not args.overwrite:
         subdirectories_to_process = []
@@ -203,8 +194,18 @@ def main():
         print(f"No new directories to process in {args.base_dir}.")
         return
 
+    if not args.no_cache:
+        _llm_cache.open_cache(args.base_dir)
+
     print(f"\nFound {len(subdirectories_to_process)} directories to process.")
-    asyncio.run(run_all(subdirectories_to_process, args.concurrency, api_key, args.model, prompt_template, args.overwrite))
+    model = args.model
+    if args.context_cache_ttl > 0:
+        static_prefix, payload_segments = split_for_context_cache(prompt_segments)
+        cached_model = use_context_cache(model, static_prefix, args.context_cache_ttl)
+        if cached_model:
+            model, prompt_segments = cached_model, payload_segments
+
+    asyncio.run(run_all(subdirectories_to_process, args.concurrency, model, prompt_segments, args.overwrite))
 
     print("\n--- Governance generation complete. ---")
 
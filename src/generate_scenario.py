@@ -3,13 +3,13 @@ import sys
 import json
 import time
 import argparse
-from typing import Optional, Dict, List, Any
-import queue
-import threading
-import re
+import asyncio
+import itertools
+from typing import Optional, Dict, List, Any, Iterator
 
-# Global lock for thread-safe file and directory operations
-file_lock = threading.Lock()
+from _gemini import genai, _get_model, RETRYABLE_ERRORS, backoff_delay, rate_limited, set_rate_limit
+from _json_utils import extract_json_from_response, write_atomic
+from _prompt_template import Segments, compile_template, _render
 
 # --- Scenario Classes (Archetypes) ---
 SCENARIO_CLASSES = [
@@ -31,71 +31,38 @@ def load_prompt_template(prompt_file: str) -> Optional[str]:
         print(f"[ERROR] Prompt file not found at: {prompt_file}")
         return None
 
-def extract_json_from_response(response_text: str) -> Optional[str]:
-    """Extracts a JSON string from a response, handling markdown and other text."""
-    if not response_text:
-        return None
-
-    # Regex to find JSON wrapped in markdown ```json ... ```
-    match = re.search(r"```json\n(.*?)\n```", response_text, re.DOTALL)
-    if match:
-        return match.group(1).strip()
-
-    # Fallback: find the first '{' or '[' and the last '}' or ']'
-    start_bracket = -1
-    end_bracket = -1
-
-    first_curly = response_text.find('{')
-    first_square = response_text.find('[')
-
-    if first_curly == -1:
-        start_bracket = first_square
-    elif first_square == -1:
-        start_bracket = first_curly
-    else:
-        start_bracket = min(first_curly, first_square)
-
-    if start_bracket == -1:
-        return None
-
-    last_curly = response_text.rfind('}')
-    last_square = response_text.rfind(']')
-    end_bracket = max(last_curly, last_square)
-
-    if end_bracket == -1 or end_bracket < start_bracket:
-        return None
-
-    return response_text[start_bracket:end_bracket + 1].strip()
-
-def call_gemini_api(prompt: str, api_key: str, model: str) -> Optional[str]:
-    """Calls the Google Gemini API and returns the response text."""
-    try:
-        import google.generativeai as genai
-    except ImportError:
-        print("[ERROR] The 'google-generativeai' package is not installed.")
-        sys.exit(1)
-
-    genai.configure(api_key=api_key)
-    model_instance = genai.GenerativeModel(model_name=model)
-    try:
-        request_options = {"timeout": 120}
-        response = model_instance.generate_content(prompt, request_options=request_options)
-        return response.text
-    except Exception as e:
-        print(f"[ERROR] An error occurred with the Gemini API: {e}")
-        return None
-
-def generate_scenario(scenario_class: str, api_key: str, model: str, prompt_template: str) -> Optional[str]:
-    """Generates a scenario JSON string based on a class."""
+async def call_gemini_api(prompt: str, model: str) -> Optional[str]:
+    """Asynchronously calls the Google Gemini API and returns the response text."""
+    model_instance = _get_model(model)
+    max_retries = 3
+    for attempt in range(max_retries):
+        try:
+            request_options = {"timeout": 120}
+            async with rate_limited():
+                response = await model_instance.generate_content_async(prompt, request_options=request_options)
+            return response.text
+        except RETRYABLE_ERRORS as e:
+            if attempt + 1 == max_retries:
+                print(f"[ERROR] Transient Gemini API error persisted after {max_retries} attempts: {e}")
+                return None
+            delay = backoff_delay(attempt)
+            print(f"[WARNING] Transient Gemini API error ({e}). Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            print(f"[ERROR] An error occurred with the Gemini API: {e}")
+            return None
+
+async def generate_scenario(scenario_class: str, model: str, prompt_segments: Segments) -> Optional[str]:
+    """Asynchronously generates a scenario JSON string based on a class."""
     print(f"Generating scenario for class '{scenario_class}'...")
-    prompt = prompt_template.replace("{scenario_class}", scenario_class)
+    prompt = _render(prompt_segments, scenario_class=scenario_class)
 
-    response_text = call_gemini_api(prompt, api_key, model)
+    response_text = await call_gemini_api(prompt, model)
     if not response_text:
         print(f"[ERROR] API call for scenario failed for class '{scenario_class}'.")
         return None
 
-    extracted_json = extract_json_from_response(response_text)
+    extracted_json = extract_json_from_response(response_text, expected_type=dict)
     if not extracted_json:
         print(f"[ERROR] Failed to extract scenario JSON from API response: {response_text}")
         return None
@@ -108,35 +75,38 @@ def generate_scenario(scenario_class: str, api_key: str, model: str, prompt_temp
         return None
 
 def get_next_run_number(base_dir: str) -> int:
-    """Gets the next available run number in a thread-safe manner."""
+    """Gets the next available run number in the base directory."""
     os.makedirs(base_dir, exist_ok=True)
-    existing_runs = [int(d) for d in os.listdir(base_dir) if d.isdigit()]
+    with os.scandir(base_dir) as entries:
+        existing_runs = [int(e.name) for e in entries if e.name.isdigit()]
     return max(existing_runs) + 1 if existing_runs else 1
 
-def worker(task_queue: queue.Queue, args: argparse.Namespace, api_key: str, prompt_template: str):
-    """Worker thread function to process scenario generation tasks."""
-    while not task_queue.empty():
-        try:
-            scenario_class = task_queue.get_nowait()
-        except queue.Empty:
-            break
+async def process_scenario_class(scenario_class: str, args: argparse.Namespace, prompt_segments: Segments, semaphore: asyncio.Semaphore, next_run: Iterator[int]):
+    """Generates and saves a single scenario, respecting the semaphore."""
+    async with semaphore:
+        scenario_json_str = await generate_scenario(scenario_class, args.model, prompt_segments)
 
-        scenario_json_str = generate_scenario(scenario_class, api_key, args.model, prompt_template)
+    if scenario_json_str:
+        run_number = next(next_run)
+        run_dir = os.path.join(args.output_dir, str(run_number))
+        os.makedirs(run_dir, exist_ok=True)
 
-        if scenario_json_str:
-            with file_lock:
-                run_number = get_next_run_number(args.output_dir)
-                run_dir = os.path.join(args.output_dir, str(run_number))
-                os.makedirs(run_dir, exist_ok=True)
-
-                scenario_path = os.path.join(run_dir, 'scenario.json')
-                with open(scenario_path, 'w') as f:
-                    f.write(scenario_json_str)
-                print(f"Successfully generated and saved scenario to {scenario_path}")
-        else:
-            print(f"[ERROR] Failed to generate scenario for class '{scenario_class}', skipping.")
-
-        task_queue.task_done()
+        scenario_path = os.path.join(run_dir, 'scenario.json')
+        write_atomic(scenario_path, scenario_json_str.encode())
+        print(f"Successfully generated and saved scenario to {scenario_path}")
+    else:
+        print(f"[ERROR] Failed to generate scenario for class '{scenario_class}', skipping.")
+
+async def run_all(scenario_classes: List[str], args: argparse.Namespace, prompt_segments: Segments):
+    """Sets up and runs the asyncio tasks for all requested scenarios."""
+    semaphore = asyncio.Semaphore(args.num_workers)
+    # Scan the output directory once; each saved scenario takes the next number
+    next_run = itertools.count(get_next_run_number(args.output_dir))
+    tasks = [
+        process_scenario_class(scenario_class, args, prompt_segments, semaphore, next_run)
+        for scenario_class in scenario_classes
+    ]
+    await asyncio.gather(*tasks)
 
 def main():
     # Determine project root to build absolute paths for defaults
@@ -151,35 +121,26 @@ def main():
     parser.add_argument("--api-key", help="Google API key (or set GOOGLE_API_KEY).")
     parser.add_argument("--classes", nargs='+', help="Specify one or more scenario classes to generate.")
     parser.add_argument("--scenario-prompt", default=default_prompt_path, help="Path to the scenario prompt file.")
-    parser.add_argument("--num-workers", type=int, default=4, help="Number of concurrent threads.")
+    parser.add_argument("--num-workers", type=int, default=4, help="Number of concurrent API requests.")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="Cap on Gemini requests per minute across all workers (0 = unlimited).")
     args = parser.parse_args()
 
     api_key = args.api_key or os.environ.get("GOOGLE_API_KEY")
     if not api_key:
         print("[ERROR] Google API key must be provided.")
         sys.exit(1)
+    genai.configure(api_key=api_key)
+    set_rate_limit(args.requests_per_minute)
 
     scenario_prompt_template = load_prompt_template(args.scenario_prompt)
     if not scenario_prompt_template:
         sys.exit(1)
+    scenario_prompt_segments = compile_template(scenario_prompt_template)
 
     target_classes = [c['class_name'] for c in SCENARIO_CLASSES if c['class_name'] in args.classes] if args.classes else [c['class_name'] for c in SCENARIO_CLASSES]
 
-    task_queue = queue.Queue()
-    for scenario_class in target_classes:
-        for _ in range(args.count):
-            task_queue.put(scenario_class)
-
-    threads = []
-    for _ in range(args.num_workers):
-        thread = threading.Thread(target=worker, args=(task_queue, args, api_key, scenario_prompt_template))
-        threads.append(thread)
-        thread.start()
-
-    task_queue.join()
-
-    for thread in threads:
-        thread.join()
+    scenario_classes = [scenario_class for scenario_class in target_classes for _ in range(args.count)]
+    asyncio.run(run_all(scenario_classes, args, scenario_prompt_segments))
 
     print("\nAll scenarios generated.")
 
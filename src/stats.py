@@ -1,94 +1,413 @@
+import hashlib
+import io
 import json
 import os
+import pickle
+import sys
 import argparse
+import array
+import math
+import threading
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 import numpy as np
-from scipy.stats import wilcoxon
+from scipy.stats import PermutationMethod, wilcoxon
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    # Built from _stats_kernels.pyx with `cythonize -i`; optional
+    import _stats_kernels
+except ImportError:
+    _stats_kernels = None
+
+from _json_utils import loads, write_atomic, write_json_atomic
+
+CACHE_DIR_NAME = '.cache'
+# Bump when the layout returned by parse_scores changes, so stale pickles are not reused
+CACHE_FORMAT = 6
+# scipy's wilcoxon switches from the exact test to the normal approximation above this sample count
+ASYMPTOTIC_MIN_SAMPLES = 50
+# Below this many differences (rows x samples) in one group, scipy's vectorized test finishes
+# before numba would even have imported and loaded its compiled kernel
+NUMBA_MIN_CELLS = 5_000_000
+# Small tied or zero-containing samples use a seeded permutation test, so reruns report the same p-values
+PERMUTATION_RESAMPLES = 9999
+PERMUTATION_BATCH = 1000
+PERMUTATION_SEED = 0
+
+# Report rows, in order; the first is the baseline the others are tested against
+FRAMEWORKS = ['mi9_governance', 'opentelemetry', 'langchain']
+# Row index of each framework, used directly as the ingest slot
+FW = {framework: i for i, framework in enumerate(FRAMEWORKS)}
+
+# evaluation.json keys read for every framework of every file
+_PC = sys.intern('performance_comparison')
+_DM = sys.intern('detection_metrics')
+_AI = sys.intern('actionable_intelligence')
+_GMS = sys.intern('governance_maturity_score')
+_METRIC_SECTIONS = (_DM, _AI)
+
+@dataclass
+class MetricTable:
+    """Scores for one metric, one row per entry in FRAMEWORKS."""
+    name: str
+    values: np.ndarray  # float64, shape (F, N), NaN-padded where a framework has fewer samples
+    mask: np.ndarray  # shape (F,), True where the framework reported this metric
+    counts: np.ndarray  # shape (F,), samples per framework
+
+def _walk(path, skip_root=False):
+    """Yield the paths of evaluation.json files under path, recursing with os.scandir."""
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        # Like os.walk, skip directories that vanish or cannot be listed
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path)
+            elif entry.name == 'evaluation.json' and not skip_root:
+                yield entry.path
 
 def load_evaluation_files(input_dir):
     """Find and load all individual evaluation.json files."""
-    eval_files = []
-    for root, _, files in os.walk(input_dir):
-        if 'evaluation.json' in files:
-            # Ignore the summary file in the root directory
-            if os.path.samefile(root, input_dir):
+    # Ignore the summary file in the root directory
+    return list(_walk(input_dir, skip_root=True))
+
+def _read_file(file_path):
+    """Read a whole file with a single open/fstat/read, bypassing Python's buffered I/O layer."""
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        data = os.read(fd, size)
+        while len(data) < size:
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+    finally:
+        os.close(fd)
+
+# simdjson parsers reuse their buffers between documents but are not thread-safe
+_thread_local = threading.local()
+# simdjson reports malformed documents as ValueError or RuntimeError
+_DECODE_ERRORS = (json.JSONDecodeError, ValueError, RuntimeError) if simdjson is not None else (json.JSONDecodeError,)
+
+def _load_json(data):
+    """Parse JSON bytes with this thread's simdjson parser, or with orjson/json when simdjson is not installed."""
+    if simdjson is None:
+        return loads(data)
+    parser = getattr(_thread_local, 'parser', None)
+    if parser is None:
+        parser = _thread_local.parser = simdjson.Parser()
+    # recursive=True builds plain dicts and lists, which outlive the parser's next document
+    return parser.parse(data, True)
+
+def _new_columns():
+    """One unboxed double buffer per entry in FRAMEWORKS."""
+    return [array.array('d') for _ in FRAMEWORKS]
+
+def _parse_one(file_path):
+    """Parse a single evaluation file into metric -> [array of scores per FRAMEWORKS entry]."""
+    scores = defaultdict(_new_columns)
+
+    try:
+        data = _load_json(_read_file(file_path))
+        if not isinstance(data, dict):
+            print(f"[WARNING] Skipping file {file_path}: expected a JSON object, got {type(data).__name__}")
+            return scores
+        comparison_data = data.get(_PC, {})
+
+        for framework, framework_data in comparison_data.items():
+            index = FW.get(framework)
+            if index is None:
                 continue
-            eval_files.append(os.path.join(root, 'evaluation.json'))
-    return eval_files
 
-def parse_scores(eval_files):
-    """Parse all evaluation files and extract performance scores for each framework."""
-    # A nested dictionary to hold lists of scores: metric -> framework -> [scores]
-    scores = defaultdict(lambda: defaultdict(list))
-
-    for file_path in eval_files:
-        with open(file_path, 'r') as f:
-            try:
-                data = json.load(f)
-                comparison_data = data.get('performance_comparison', {})
-
-                for framework, framework_data in comparison_data.items():
-                    # Collect governance maturity score
-                    maturity_score = framework_data.get('governance_maturity_score')
-                    if maturity_score is not None:
-                        scores['governance_maturity_score'][framework].append(maturity_score)
-
-                    # Collect detection metrics
-                    detection_metrics = framework_data.get('detection_metrics', {})
-                    for metric, value in detection_metrics.items():
-                        if isinstance(value, (int, float)):
-                            scores[metric][framework].append(value)
-
-                    # Collect actionable intelligence metrics
-                    actionable_intel = framework_data.get('actionable_intelligence', {})
-                    for metric, value in actionable_intel.items():
-                        if isinstance(value, (int, float)):
-                            scores[metric][framework].append(value)
-
-            except (json.JSONDecodeError, KeyError) as e:
-                print(f"[WARNING] Skipping file {file_path} due to error: {e}")
+            # Collect governance maturity score
+            maturity_score = framework_data.get(_GMS)
+            if maturity_score is not None:
+                scores[_GMS][index].append(maturity_score)
+
+            # Collect detection and actionable intelligence metrics
+            for section in _METRIC_SECTIONS:
+                for metric, value in framework_data.get(section, {}).items():
+                    if isinstance(value, (int, float)):
+                        scores[metric][index].append(value)
+
+    except (*_DECODE_ERRORS, KeyError) as e:
+        print(f"[WARNING] Skipping file {file_path} due to error: {e}")
 
     return scores
 
-def print_statistics_report(scores):
+def parse_scores(eval_files):
+    """Parse all evaluation files and extract performance scores for each framework.
+
+    Returns one MetricTable per metric, sorted by metric name. Frameworks
+    outside FRAMEWORKS are dropped.
+    """
+    # Unboxed doubles during ingest: metric -> [array('d') per FRAMEWORKS entry]
+    scores = defaultdict(_new_columns)
+
+    # Files are independent and I/O-bound; map() keeps file order, so scores stay paired
+    with ThreadPoolExecutor(max_workers=(os.cpu_count() or 1) * 2) as executor:
+        for file_scores in executor.map(_parse_one, eval_files):
+            for metric, file_columns in file_scores.items():
+                for column, values in zip(scores[metric], file_columns):
+                    column.extend(values)
+
+    tables = []
+    # Sorted once here, so the report and the cached tables share one stable order
+    for metric in sorted(scores):
+        columns = scores[metric]
+        counts = np.array([len(column) for column in columns])
+        # float64, as parsed: narrower storage would change which decimal ties survive
+        # in the paired differences, and with them the reported p-values
+        values = np.full((len(FRAMEWORKS), counts.max()), np.nan)
+        for row, column in zip(values, columns):
+            row[:len(column)] = np.frombuffer(column, dtype=np.float64)
+        tables.append(MetricTable(metric, values, counts > 0, counts))
+    return tables
+
+def _cache_path(input_dir, eval_files):
+    """Return the score cache path for this exact set of files and modification times."""
+    h = hashlib.blake2b(digest_size=8)
+    h.update(f"format={CACHE_FORMAT}\n".encode())
+    for file_path in sorted(eval_files):
+        st = os.stat(file_path)
+        h.update(f"{file_path}\x00{st.st_mtime_ns}\x00{st.st_size}\n".encode())
+    return os.path.join(input_dir, CACHE_DIR_NAME, f"stats_{h.hexdigest()}.pkl")
+
+def load_cached_scores(cache_path):
+    """Return previously parsed scores from cache_path, or None on a miss."""
+    try:
+        with open(cache_path, 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+        print(f"[WARNING] Ignoring unreadable score cache {cache_path}: {e}")
+        return None
+
+def save_cached_scores(cache_path, scores):
+    """Pickle scores to cache_path; the cache is best-effort, so write failures only warn."""
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        write_atomic(cache_path, pickle.dumps(scores, protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError as e:
+        print(f"[WARNING] Could not write score cache {cache_path}: {e}")
+
+# numba, once imported by _get_wilcoxon_batch()
+numba = None
+# The compiled kernel, False once numba turned out to be unavailable
+_wilcoxon_batch = None
+
+def _get_wilcoxon_batch():
+    """Import numba and compile wilcoxon_batch() on first use; None when numba is not installed."""
+    global numba, _wilcoxon_batch
+    if _wilcoxon_batch is None:
+        try:
+            import numba
+        except ImportError:
+            _wilcoxon_batch = False
+        else:
+            _wilcoxon_batch = numba.njit(parallel=True, cache=True)(wilcoxon_batch)
+    return _wilcoxon_batch or None
+
+def wilcoxon_batch(diffs):
+    """Two-sided asymptotic Wilcoxon signed-rank p-values for each row of diffs.
+
+    Matches scipy.stats.wilcoxon(method='asymptotic') with its defaults:
+    zeros are dropped, ties get average ranks and no continuity correction.
+    Written for numba; call the compiled version from _get_wilcoxon_batch().
+    """
+    num_rows, num_samples = diffs.shape
+    pvalues = np.empty(num_rows)
+    for row in numba.prange(num_rows):
+        d = diffs[row]
+        abs_d = np.abs(d)
+        order = np.argsort(abs_d)
+
+        # Zeros sort first; skip them rather than filtering into a copy
+        start = 0
+        while start < num_samples and abs_d[order[start]] == 0:
+            start += 1
+        n = num_samples - start
+        if n == 0:
+            pvalues[row] = np.nan
+            continue
+
+        # One walk over the tie runs accumulates the signed rank sum W = r_plus - r_minus
+        # and the tie correction together
+        w = 0.0
+        tie_correct = 0.0
+        i = start
+        while i < num_samples:
+            j = i + 1
+            while j < num_samples and abs_d[order[j]] == abs_d[order[i]]:
+                j += 1
+            # Positions i..j-1 share the average of ranks i-start+1..j-start
+            rank = (i + j + 1) / 2.0 - start
+            for k in range(i, j):
+                w += rank if d[order[k]] > 0 else -rank
+            t = j - i
+            tie_correct += t * t * t - t
+            i = j
+
+        # r_plus - n(n+1)/4 == W/2
+        se = math.sqrt((n * (n + 1.0) * (2.0 * n + 1.0) - tie_correct / 2) / 24)
+        z = w / (2.0 * se)
+        pvalues[row] = math.erfc(abs(z) / math.sqrt(2.0))
+    return pvalues
+
+def _permutation_method():
+    """A freshly seeded PermutationMethod for one batch of Wilcoxon tests."""
+    rng = np.random.default_rng(PERMUTATION_SEED)
+    try:
+        return PermutationMethod(n_resamples=PERMUTATION_RESAMPLES, batch=PERMUTATION_BATCH, rng=rng)
+    except TypeError:
+        # scipy < 1.15 names the generator argument random_state
+        return PermutationMethod(n_resamples=PERMUTATION_RESAMPLES, batch=PERMUTATION_BATCH, random_state=rng)
+
+def _batch_pvalues(diffs):
+    """Wilcoxon p-values for rows of equal length.
+
+    Large samples use the normal approximation, as scipy does by default. Small
+    samples use the exact test when they have no ties or zeros, and a
+    permutation test otherwise, where scipy would fall back to the normal
+    approximation above 13 samples.
+    """
+    if diffs.shape[1] > ASYMPTOTIC_MIN_SAMPLES:
+        if _stats_kernels is not None:
+            return _stats_kernels.wilcoxon_rows(diffs)
+        if diffs.size >= NUMBA_MIN_CELLS:
+            kernel = _get_wilcoxon_batch()
+            if kernel is not None:
+                return kernel(diffs)
+        return wilcoxon(diffs, axis=1).pvalue
+
+    # The method is fixed per subset, since scipy's 'auto' would pick one from the whole input
+    abs_sorted = np.sort(np.abs(diffs), axis=1)
+    exact = (np.count_nonzero(diffs, axis=1) == diffs.shape[1]) & np.all(np.diff(abs_sorted, axis=1) != 0, axis=1)
+    pvalues = np.empty(len(diffs))
+    if exact.any():
+        pvalues[exact] = wilcoxon(diffs[exact], axis=1, method='exact').pvalue
+    if not exact.all():
+        # Zeros are dropped inside the statistic, so rows can be tested together
+        pvalues[~exact] = wilcoxon(diffs[~exact], axis=1, method=_permutation_method()).pvalue
+    return pvalues
+
+def wilcoxon_pvalues(tables):
+    """Run Wilcoxon signed-rank tests of each framework against mi9_governance.
+
+    Returns (metric, framework) -> p-value, or None when the paired scores do not
+    differ. Tests with the same sample count run together in one vectorized call.
+    """
+    pvalues = {}
+    groups = defaultdict(list)  # sample count -> [((metric, framework), mi9_arr, compare_arr)]
+    for table in tables:
+        if not table.mask[0]:
+            continue
+        num_samples = int(table.counts[0])
+        mi9_arr = table.values[0, :num_samples]
+        for i in range(1, len(FRAMEWORKS)):
+            if table.mask[i] and table.counts[i] == num_samples:
+                groups[num_samples].append(((table.name, FRAMEWORKS[i]), mi9_arr, table.values[i, :num_samples]))
+
+    for num_samples, rows in groups.items():
+        # Subtract straight into the rows of the stacked matrix, no per-pair temporaries
+        diffs = np.empty((len(rows), num_samples))
+        for diff, (_, mi9_arr, compare_arr) in zip(diffs, rows):
+            np.subtract(mi9_arr, compare_arr, out=diff)
+
+        # Wilcoxon test requires non-zero differences
+        differs = np.count_nonzero(diffs, axis=1) > 0
+        keys = [key for key, _, _ in rows]
+        pvalues.update((key, None) for key, row_differs in zip(keys, differs) if not row_differs)
+        tested = [key for key, row_differs in zip(keys, differs) if row_differs]
+        if tested:
+            pvalues.update(zip(tested, _batch_pvalues(diffs[differs])))
+    return pvalues
+
+def _mean_std(table):
+    """Return the reporting frameworks of a table with their score means and standard deviations."""
+    present = table.values[table.mask]
+    counts = table.counts[table.mask]
+    if len(counts) and (counts == counts[0]).all():
+        # Equal sample counts: no padding, reduce all frameworks in one (F, N) pass
+        means = present.mean(axis=1)
+        stds = present.std(axis=1)
+    else:
+        means = np.nanmean(present, axis=1)
+        stds = np.nanstd(present, axis=1)
+    frameworks = [framework for framework, reported in zip(FRAMEWORKS, table.mask) if reported]
+    return frameworks, means, stds
+
+def _num_samples(tables):
+    """Number of mi9_governance maturity scores, i.e. of valid evaluations."""
+    return next((int(t.counts[0]) for t in tables if t.name == _GMS), 0)
+
+def save_summary(path, tables, pvalues):
+    """Write the per-metric means, standard deviations and p-values to path as JSON."""
+    metrics = {}
+    for table in tables:
+        frameworks, means, stds = _mean_std(table)
+        metrics[table.name] = {
+            'frameworks': frameworks,
+            'mean': means,
+            'std': stds,
+            'count': table.counts[table.mask],
+            'p_values': {
+                framework: pvalues[(table.name, framework)]
+                for framework in FRAMEWORKS[1:] if (table.name, framework) in pvalues
+            },
+        }
+    # ndarrays are serialized as-is by orjson's OPT_SERIALIZE_NUMPY
+    write_json_atomic(path, {'num_samples': _num_samples(tables), 'metrics': metrics})
+    print(f"[SUCCESS] Saved statistics summary to {path}")
+
+def print_statistics_report(tables, pvalues=None):
     """Calculate and print the statistical analysis report."""
-    frameworks = ['mi9_governance', 'opentelemetry', 'langchain']
-    metrics = sorted(scores.keys())
+    if pvalues is None:
+        pvalues = wilcoxon_pvalues(tables)
+    num_samples = _num_samples(tables)
+    # Built in memory and written once, rather than one locked stdout write per line
+    out = io.StringIO()
 
-    print("--- Statistical Performance Analysis ---")
-    print(f"Based on {len(scores['governance_maturity_score']['mi9_governance'])} valid evaluation samples.\n")
+    print("--- Statistical Performance Analysis ---", file=out)
+    print(f"Based on {num_samples} valid evaluation samples.\n", file=out)
 
-    for metric in metrics:
-        print(f"\n--- Metric: {metric} ---")
+    for table in tables:
+        metric = table.name
+        print(f"\n--- Metric: {metric} ---", file=out)
         header = f"{'Framework':<20} | {'Mean':<10} | {'Std Dev':<10}"
-        print(header)
-        print("-" * len(header))
+        print(header, file=out)
+        print("-" * len(header), file=out)
 
-        metric_scores = scores[metric]
-        for framework in frameworks:
-            if framework in metric_scores:
-                mean = np.mean(metric_scores[framework])
-                std = np.std(metric_scores[framework])
-                print(f"{framework:<20} | {mean:<10.4f} | {std:<10.4f}")
+        frameworks, means, stds = _mean_std(table)
+        for framework, mean, std in zip(frameworks, means, stds):
+            print(f"{framework:<20} | {mean:<10.4f} | {std:<10.4f}", file=out)
 
         # Perform significance testing against MI9
-        print("\n  Significance Tests (Wilcoxon signed-rank vs. mi9_governance):")
-        mi9_scores = metric_scores.get('mi9_governance')
-        if mi9_scores:
-            for framework_to_compare in ['opentelemetry', 'langchain']:
-                compare_scores = metric_scores.get(framework_to_compare)
-                if compare_scores and len(mi9_scores) == len(compare_scores):
-                    # Wilcoxon test requires non-zero differences
-                    diff = np.array(mi9_scores) - np.array(compare_scores)
-                    if np.any(diff):
-                        stat, p_value = wilcoxon(diff)
-                        significance = '***' if p_value < 0.001 else '**' if p_value < 0.01 else '*' if p_value < 0.05 else 'ns'
-                        print(f"    - vs. {framework_to_compare:<15}: p-value = {p_value:.4e} ({significance})")
-                    else:
-                        print(f"    - vs. {framework_to_compare:<15}: No difference in scores.")
-
-    print("\n--- End of Report ---")
-    print("Significance levels: *** p < 0.001, ** p < 0.01, * p < 0.05, ns (not significant)")
+        print("\n  Significance Tests (Wilcoxon signed-rank vs. mi9_governance):", file=out)
+        for framework_to_compare in FRAMEWORKS[1:]:
+            if (metric, framework_to_compare) not in pvalues:
+                continue
+            p_value = pvalues[(metric, framework_to_compare)]
+            if p_value is not None:
+                significance = '***' if p_value < 0.001 else '**' if p_value < 0.01 else '*' if p_value < 0.05 else 'ns'
+                print(f"    - vs. {framework_to_compare:<15}: p-value = {p_value:.4e} ({significance})", file=out)
+            else:
+                print(f"    - vs. {framework_to_compare:<15}: No difference in scores.", file=out)
+
+    print("\n--- End of Report ---", file=out)
+    print("Significance levels: *** p < 0.001, ** p < 0.01, * p < 0.05, ns (not significant)", file=out)
+    sys.stdout.write(out.getvalue())
 
 def main():
     parser = argparse.ArgumentParser(description="Perform statistical analysis on MI9 evaluation results.")
@@ -98,6 +417,17 @@ def main():
         default='../data',
         help='Directory containing the per-scenario evaluation run folders.'
     )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Reparse every evaluation file and neither read nor write the score cache.'
+    )
+    parser.add_argument(
+        '--summary-json',
+        type=str,
+        default=None,
+        help='Optional path to also write the means, standard deviations and p-values as JSON.'
+    )
     args = parser.parse_args()
 
     print(f"Running analysis on: {os.path.abspath(args.input_dir)}")
@@ -107,8 +437,18 @@ def main():
         print("[ERROR] No 'evaluation.json' files found in the subdirectories. Aborting.")
         return
 
-    scores = parse_scores(eval_files)
-    print_statistics_report(scores)
+    if args.no_cache:
+        tables = parse_scores(eval_files)
+    else:
+        cache_path = _cache_path(args.input_dir, eval_files)
+        tables = load_cached_scores(cache_path)
+        if tables is None:
+            tables = parse_scores(eval_files)
+            save_cached_scores(cache_path, tables)
+    pvalues = wilcoxon_pvalues(tables)
+    print_statistics_report(tables, pvalues)
+    if args.summary_json:
+        save_summary(args.summary_json, tables, pvalues)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+import _llm_cache
+import evaluate_governance
+from _prompt_template import compile_template
+
+
+def test_run_all_default_batch_size_evaluates_every_run(tmp_path, monkeypatch):
+    run_dirs = []
+    for name in ('1', '2', '3'):
+        run_dir = tmp_path / name
+        run_dir.mkdir()
+        run_dirs.append(str(run_dir))
+
+    async def fake_process_run_directory(run_dir, prompt_segments, model):
+        return {'run': os.path.basename(run_dir)}
+
+    monkeypatch.setattr(evaluate_governance, 'process_run_directory', fake_process_run_directory)
+
+    # batch_size is left at its default of 0, as in a plain CLI run
+    results = asyncio.run(evaluate_governance.run_all(run_dirs, 2, 'fake-model', compile_template('{logs}')))
+
+    assert sorted(result['run'] for result in results) == ['1', '2', '3']
+    for run_dir in run_dirs:
+        assert os.path.exists(os.path.join(run_dir, 'evaluation.json'))
+
+
+class _FlakyModel:
+    """Raises ResourceExhausted for the first `failures` calls, then answers."""
+
+    def __init__(self, failures, text='```json\n{"ok": true}\n```'):
+        self.failures = failures
+        self.text = text
+        self.calls = 0
+
+    async def generate_content_async(self, prompt, request_options=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise evaluate_governance.RETRYABLE_ERRORS[0]("quota exceeded")
+        return type('Response', (), {'text': self.text})()
+
+
+def _patch_gemini(monkeypatch, model):
+    sleeps = []
+
+    async def fake_sleep(delay):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(evaluate_governance, 'build_evaluation_prompt', lambda run_dir, segments: 'prompt')
+    monkeypatch.setattr(evaluate_governance, '_get_model', lambda model_name: model)
+    monkeypatch.setattr(evaluate_governance.asyncio, 'sleep', fake_sleep)
+    return sleeps
+
+
+def test_process_run_directory_retries_transient_errors(monkeypatch):
+    model = _FlakyModel(failures=2)
+    sleeps = _patch_gemini(monkeypatch, model)
+
+    result = asyncio.run(evaluate_governance.process_run_directory('run', compile_template(''), 'fake-model'))
+
+    assert result == {'ok': True}
+    assert model.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_process_run_directory_gives_up_without_a_final_sleep(monkeypatch):
+    model = _FlakyModel(failures=10)
+    sleeps = _patch_gemini(monkeypatch, model)
+
+    result = asyncio.run(evaluate_governance.process_run_directory('run', compile_template(''), 'fake-model'))
+
+    assert result is None
+    assert model.calls == 3
+    assert len(sleeps) == 2
+
+
+def test_process_run_directory_does_not_cache_unparseable_responses(tmp_path, monkeypatch):
+    model = _FlakyModel(failures=0, text='Result: {"score": 5,}')
+    _patch_gemini(monkeypatch, model)
+    monkeypatch.setattr(_llm_cache, '_conn', None)
+    _llm_cache.open_cache(str(tmp_path))
+
+    for _ in range(2):
+        result = asyncio.run(evaluate_governance.process_run_directory('run', compile_template(''), 'fake-model'))
+        assert result is None
+
+    # The bad response was not replayed from the cache, so both runs asked the model
+    assert model.calls == 2
+
+
+def test_parse_evaluation_skips_bracketed_asides():
+    response = 'Per the rubric [1], here is the evaluation: {"performance_comparison": {}}'
+
+    assert evaluate_governance.parse_evaluation('run', response) == {'performance_comparison': {}}
+
+
+def test_parse_evaluation_rejects_non_object_payloads():
+    assert evaluate_governance.parse_evaluation('run', 'Scores: [1, 2, 3]') is None